@@ -0,0 +1,32 @@
+# backend/app/export_onnx.py
+"""
+Export FLAN-T5 to ONNX and quantize it to INT8 (dynamic) for ONNX Runtime.
+
+Run once from backend/:
+    python -m app.export_onnx flan_t5_onnx_int8
+then start the API with SIMPLIFIER_ONNX_DIR=flan_t5_onnx_int8.
+"""
+
+import sys, tempfile
+from pathlib import Path
+from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+MODEL_NAME = "google/flan-t5-small"
+
+def export(out_dir: str) -> None:
+    out = Path(out_dir)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        model = ORTModelForSeq2SeqLM.from_pretrained(MODEL_NAME, export=True)
+        model.save_pretrained(tmp)
+        # encoder / decoder graphs are quantized separately; keep the original file names
+        for onnx_file in sorted(Path(tmp).glob("*.onnx")):
+            quantizer = ORTQuantizer.from_pretrained(tmp, file_name=onnx_file.name)
+            quantizer.quantize(save_dir=out, quantization_config=qconfig, file_suffix="")
+        model.config.save_pretrained(out)
+        model.generation_config.save_pretrained(out)
+    print(f"Saved INT8 ONNX model to {out}")
+
+if __name__ == "__main__":
+    export(sys.argv[1] if len(sys.argv) > 1 else "flan_t5_onnx_int8")